@@ -1,12 +1,17 @@
+import codecs
 import gzip
+import io
 import json
+import locale
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
-from typing import Any, Iterator, Literal, override
+from typing import Annotated, Any, Iterable, Iterator, Literal, override
 
 import regex
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, TypeAdapter
 from regex import Pattern
 
 from .typing import StrOrPath
@@ -15,10 +20,45 @@ logger = logging.getLogger(__name__)
 
 
 def _resolve_parent(path: StrOrPath):
+    path = os.fspath(path)
+    # Relative paths resolve against the working directory, so it is part of the key.
+    return _resolve_parent_cached(path, None if os.path.isabs(path) else os.getcwd())
+
+
+@lru_cache(maxsize=1024)
+def _resolve_parent_cached(path: str, cwd: str | None) -> Path:
     p = Path(path).resolve()
     return p.parent if p.is_file() else p
 
 
+@lru_cache(maxsize=256)
+def _compile(pattern: str) -> Pattern[str]:
+    return regex.compile(pattern)
+
+
+@lru_cache(maxsize=256)
+def _literal_prefix(pattern: str) -> str:
+    """Return a literal prefix that every full match of the pattern starts with."""
+    if pattern.startswith("(?") or "|" in pattern:
+        return ""
+
+    prefix = ""
+    for i, c in enumerate(pattern):
+        if c in ".^$*+?{}[]()\\|":
+            break
+        if pattern[i + 1 : i + 2] in ("*", "+", "?", "{"):
+            break
+        prefix += c
+    return prefix
+
+
+def _name_matches(name: str, pattern: Pattern[str] | None, prefix: str) -> bool:
+    """Names without the literal prefix are rejected before running the regex."""
+    if pattern is None:
+        return True
+    return name.startswith(prefix) and pattern.fullmatch(name) is not None
+
+
 #### Text sources ####
 
 
@@ -39,18 +79,35 @@ class FindFileSource(TextSourceModel):
     file_pattern: str | None = None
     dir_pattern: str | None = None
 
+    @property
+    def _file_re(self) -> Pattern[str] | None:
+        return _compile(self.file_pattern) if self.file_pattern else None
+
+    @property
+    def _dir_re(self) -> Pattern[str] | None:
+        return _compile(self.dir_pattern) if self.dir_pattern else None
+
+    @property
+    def _file_prefix(self) -> str:
+        return _literal_prefix(self.file_pattern) if self.file_pattern else ""
+
+    @property
+    def _dir_prefix(self) -> str:
+        return _literal_prefix(self.dir_pattern) if self.dir_pattern else ""
+
     @override
     def get_texts(self, this_path):
-        dir_pattern = regex.compile(self.dir_pattern) if self.dir_pattern else None
-        file_pattern = regex.compile(self.file_pattern) if self.file_pattern else None
-
         base_path = _resolve_parent(this_path) / self.base
 
         for path in self.paths:
             yield from (
                 str(p)
                 for p in self._search_dir(
-                    base_path / path, file_pattern=file_pattern, dir_pattern=dir_pattern
+                    base_path / path,
+                    file_pattern=self._file_re,
+                    dir_pattern=self._dir_re,
+                    file_prefix=self._file_prefix,
+                    dir_prefix=self._dir_prefix,
                 )
             )
 
@@ -60,15 +117,34 @@ class FindFileSource(TextSourceModel):
         *,
         file_pattern: Pattern[str] | None = None,
         dir_pattern: Pattern[str] | None = None,
+        file_prefix: str = "",
+        dir_prefix: str = "",
     ) -> Iterator[Path]:
-        for cur_dir, dirs, files in os.walk(dir):
-            if dir_pattern is not None:
-                dirs[:] = [d for d in dirs if dir_pattern.fullmatch(d)]
-
-            for file in files:
-                if file_pattern is not None and not file_pattern.fullmatch(file):
-                    continue
-                yield Path(cur_dir) / file
+        # Same traversal order as `os.walk`, but names are tested on the `DirEntry`
+        # before any path is built.
+        stack = [os.fspath(dir)]
+        while stack:
+            subdirs: list[str] = []
+            try:
+                with os.scandir(stack.pop()) as it:
+                    for entry in it:
+                        name = entry.name
+                        try:
+                            is_dir = entry.is_dir()
+                        except OSError:
+                            is_dir = False
+
+                        if is_dir:
+                            if not entry.is_symlink() and _name_matches(
+                                name, dir_pattern, dir_prefix
+                            ):
+                                subdirs.append(entry.path)
+                        elif _name_matches(name, file_pattern, file_prefix):
+                            yield Path(entry.path)
+            except OSError:
+                pass
+
+            stack.extend(reversed(subdirs))
 
 
 class PlainTextSource(TextSourceModel):
@@ -88,19 +164,65 @@ class ProcessSource(TextSourceModel):
     type: Literal["process"]
     operations: list[Operation]
     sources: list[TextSource]
+    parallel: int = Field(default=1, ge=1)
 
     @override
     def get_texts(self, this_path):
+        operations = self._fuse_operations()
+
+        # Only file reading releases the GIL, so other pipelines stay sequential.
+        if (
+            self.parallel > 1
+            and self.operations
+            and isinstance(self.operations[0], ReadFileOperation)
+        ):
+            yield from self._get_texts_parallel(operations, this_path)
+            return
+
         for source in self.sources:
-            for text in source.get_texts(this_path):
-                texts = [text]
-                for operation in self.operations:
-                    tmp: list[str] = []
-                    for text in texts:
-                        tmp.extend(operation.process(text, this_path))
-                    texts = tmp
+            yield from _process(operations, source.get_texts(this_path), this_path)
+
+    def _get_texts_parallel(
+        self, operations: list[OperationModel], this_path: StrOrPath
+    ) -> Iterator[str]:
+        def process_one(text: str) -> list[str]:
+            return list(_process(operations, [text], this_path))
+
+        with ThreadPoolExecutor(self.parallel) as executor:
+            for source in self.sources:
+                # `map` keeps the source order; `buffersize` keeps it streaming.
+                for texts in executor.map(
+                    process_one,
+                    source.get_texts(this_path),
+                    buffersize=self.parallel * 4,
+                ):
+                    yield from texts
+
+    def _fuse_operations(self) -> list[OperationModel]:
+        """Operations to run, with a per-line strip followed by `split_lines` fused."""
+        operations: list[OperationModel] = []
+        for operation in self.operations:
+            last = operations[-1] if operations else None
+            if (
+                isinstance(operation, SplitLinesOperation)
+                and not operation.keep_ends
+                and isinstance(last, StripOperation | RightStripOperation)
+                and last.per_line
+            ):
+                operations[-1] = _StripSplitLinesOperation(
+                    chars=last.chars, leading=isinstance(last, StripOperation)
+                )
+            else:
+                operations.append(operation)
+        return operations
+
 
-                yield from texts
+def _process(
+    operations: Iterable[OperationModel], texts: Iterable[str], this_path: StrOrPath
+) -> Iterator[str]:
+    for operation in operations:
+        texts = operation.process_stream(texts, this_path)
+    yield from texts
 
 
 type TextSource = FindFileSource | PlainTextSource | ProcessSource
@@ -120,6 +242,18 @@ class OperationModel(BaseModel):
 
     def process(self, text: str, this_path: StrOrPath) -> Iterator[str]: ...
 
+    def process_stream(
+        self, texts: Iterable[str], this_path: StrOrPath
+    ) -> Iterator[str]:
+        """Lazily apply this operation to each of the texts."""
+        for text in texts:
+            yield from self.process(text, this_path)
+
+
+@lru_cache(maxsize=16)
+def _is_utf8_encoding(encoding: str) -> bool:
+    return codecs.lookup(encoding).name == "utf-8"
+
 
 class ReadFileOperation(OperationModel):
     """Read file content."""
@@ -132,18 +266,37 @@ class ReadFileOperation(OperationModel):
     @override
     def process(self, text: str, this_path):
         path = _resolve_parent(this_path) / self.base / text
-        try:
-            match self.compression:
-                case "gzip":
-                    f = gzip.open(path, "rt", encoding=self.encoding)
-                case _:
-                    f = open(path, "r", encoding=self.encoding)
+        # Read all bytes at once (unbuffered) and decode them in a single call.
+        match self.compression:
+            case "gzip":
+                data = gzip.decompress(path.read_bytes())
+            case _:
+                data = path.read_bytes()
 
-            yield f.read()
-
-            f.close()
+        try:
+            content = self._decode(data)
         except UnicodeDecodeError:
             logger.warning(f'UnicodeDecodeError in file: "{path}"')
+            return
+
+        # Do not keep the raw bytes alive while the generator is suspended.
+        del data
+        yield content
+
+    @property
+    def _is_utf8(self) -> bool:
+        return _is_utf8_encoding(self.encoding or locale.getpreferredencoding(False))
+
+    def _decode(self, data: bytes) -> str:
+        """Decode the same way as reading the file in text mode."""
+        if not self._is_utf8:
+            with io.TextIOWrapper(io.BytesIO(data), encoding=self.encoding) as f:
+                return f.read()
+
+        text = data.decode("utf-8")
+        if "\r" in text:
+            text = text.replace("\r\n", "\n").replace("\r", "\n")
+        return text
 
 
 class ReferenceOperation(OperationModel):
@@ -155,23 +308,36 @@ class ReferenceOperation(OperationModel):
 
     @override
     def process(self, text: str, this_path):
-        texts = [text]
+        yield from self.process_stream([text], this_path)
+
+    @override
+    def process_stream(self, texts, this_path):
         for path in self.paths:
             ref_path = _resolve_parent(this_path) / self.base / path
             for operation in self._get_operations(ref_path):
-                tmp: list[str] = []
-                for text in texts:
-                    tmp.extend(operation.process(text, ref_path))
-                texts = tmp
+                texts = operation.process_stream(texts, ref_path)
 
         yield from texts
 
-    def _get_operations(self, path: StrOrPath) -> Iterator[Operation]:
-        with open(path, "r") as f:
-            array = json.load(f)
+    def _get_operations(self, path: StrOrPath) -> tuple[Operation, ...]:
+        return _load_operations(str(path), os.stat(path).st_mtime_ns)
+
+
+@lru_cache(maxsize=128)
+def _load_operations(path: str, mtime_ns: int) -> tuple[Operation, ...]:
+    """Parse and validate an operation file, cached until the file is modified."""
+    with open(path, "r") as f:
+        array = json.load(f)
 
-        for obj in array:
-            yield OperationWrapperModel.model_validate({"operation": obj}).operation
+    return tuple(_OPERATION_ADAPTER.validate_python(obj) for obj in array)
+
+
+_REGEX_METACHARACTERS = regex.compile(r"[.*+?\[\](){}|^$\\]")
+
+
+@lru_cache(maxsize=256)
+def _needs_regex(pattern: str, template: str) -> bool:
+    return _REGEX_METACHARACTERS.search(pattern) is not None or "\\" in template
 
 
 class ReplaceOperation(OperationModel):
@@ -184,29 +350,53 @@ class ReplaceOperation(OperationModel):
     repeat: bool = False
     per_line: bool = False
 
+    @property
+    def _compiled(self) -> Pattern[str]:
+        return _compile(self.old)
+
+    @property
+    def _effective_regex(self) -> bool:
+        """Whether the regex engine is needed (not for a literal pattern and template)."""
+        return self.regex and _needs_regex(self.old, self.new)
+
     @override
     def process(self, text: str, this_path):
         if self.per_line:
-            yield "\n".join(self._apply_replace(line) for line in text.splitlines())
+            if not self._effective_regex and self.old and "\n" not in self.old:
+                # A match can never span lines, so replace in the joined text.
+                yield self._apply_replace("\n".join(text.splitlines()))
+            else:
+                yield "\n".join(self._apply_replace(line) for line in text.splitlines())
         else:
             yield self._apply_replace(text)
 
     def _apply_replace(self, text: str) -> str:
         if self.repeat:
-            last_text = text
-            while True:
-                if self.regex:
-                    text = regex.sub(self.old, self.new, text)
-                else:
-                    text = text.replace(self.old, self.new)
-
-                if text == last_text:
-                    break
+            if self._effective_regex:
                 last_text = text
-            return text
+                while True:
+                    text, count = self._compiled.subn(self.new, text)
+                    # No match left means the next pass cannot change anything.
+                    if (
+                        count == 0
+                        or self._compiled.search(text) is None
+                        or text == last_text
+                    ):
+                        break
+                    last_text = text
+                return text
+            else:
+                if self.old == self.new:
+                    return text
+                if len(self.old) == 1 and self.old not in self.new:
+                    # A single character cannot be formed again across replacements.
+                    return text.replace(self.old, self.new)
+                while self.old in text:
+                    text = text.replace(self.old, self.new)
+                return text
         else:
-            if self.regex:
-                return regex.sub(self.old, self.new, text)
+            if self._effective_regex:
+                return self._compiled.sub(self.new, text)
             else:
                 return text.replace(self.old, self.new)
 
@@ -252,6 +442,23 @@ class StripOperation(OperationModel):
             yield text.strip(self.chars)
 
 
+class _StripSplitLinesOperation(OperationModel):
+    """Strip each line and split text into lines (fused by `ProcessSource`)."""
+
+    chars: str | None = None
+    leading: bool = True
+
+    @override
+    def process(self, text: str, this_path):
+        strip = str.strip if self.leading else str.rstrip
+        lines = text.splitlines()
+        # Splitting the joined lines would drop a trailing line left empty.
+        if lines and not strip(lines[-1], self.chars):
+            lines.pop()
+        for line in lines:
+            yield strip(line, self.chars)
+
+
 type Operation = ReadFileOperation | ReferenceOperation | ReplaceOperation | RightStripOperation | SplitLinesOperation | StripOperation
 
 
@@ -259,6 +466,15 @@ class OperationWrapperModel(BaseModel):
     operation: Operation = Field(discriminator="type")
 
 
+# Reused validators for the discriminated unions, without the wrapper models.
+_TEXT_SOURCE_ADAPTER: TypeAdapter[TextSource] = TypeAdapter(
+    Annotated[TextSource, Field(discriminator="type")]
+)
+_OPERATION_ADAPTER: TypeAdapter[Operation] = TypeAdapter(
+    Annotated[Operation, Field(discriminator="type")]
+)
+
+
 def get_texts(obj: Any, this_path: StrOrPath = ".") -> Iterator[str]:
-    source = TextSourceWrapperModel.model_validate({"source": obj}).source
+    source = _TEXT_SOURCE_ADAPTER.validate_python(obj)
     yield from source.get_texts(this_path)